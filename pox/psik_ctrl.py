@@ -26,6 +26,9 @@ import pox.lib.revent as revent               # Event library
 import pox.lib.recoco as recoco               # Multitasking library
 import random
 import copy
+import json
+import os
+import time
 
 class DecisionType:
     DEC_STATIC = 1
@@ -43,10 +46,69 @@ class PSIKSwitch(object):
         self.connection = connection
         connection.addListeners(self)
 
+    def get_state(self):
+        return {"dpid": self.dpid}
+
+    def restore_state(self, state):
+        pass
+
 class PSIKLearningSwitch(PSIKSwitch):
     def __init__(self, sid, dpid, connection = None):
         super(PSIKLearningSwitch, self).__init__(sid, dpid, connection)
         self.macToPort = {}
+        self.restore_barrier_xid = None
+
+    def get_state(self):
+        state = super(PSIKLearningSwitch, self).get_state()
+        state["macToPort"] = dict((str(mac), port)
+                                  for mac, port in self.macToPort.items())
+        return state
+
+    def restore_state(self, state):
+        super(PSIKLearningSwitch, self).restore_state(state)
+        # Validate whole table before touching our own
+        macToPort = {}
+        for mac, port in state.get("macToPort", {}).items():
+            if (not isinstance(port, (int, long)) or isinstance(port, bool)
+                    or not 1 <= port <= of.OFPP_MAX):
+                raise ValueError("Invalid port %r for %s" % (port, mac))
+            try:
+                macToPort[EthAddr(str(mac))] = port
+            except (RuntimeError, TypeError, ValueError):
+                raise ValueError("Invalid MAC address %r" % (mac,))
+        self.macToPort.update(macToPort)
+
+        if self.connection is None or len(self.macToPort) == 0:
+            return
+
+        # Push flows for all pairs of restored hosts in one go, so traffic
+        # keeps flowing without waiting for a PacketIn for each of them.
+        # Packets from unknown hosts still reach us, so learning goes on.
+        # Timeouts are the same as for learned flows.
+        n_flows = 0
+        for src, src_port in self.macToPort.items():
+            for dst, dst_port in self.macToPort.items():
+                if src == dst or src_port == dst_port:
+                    continue
+                msg = of.ofp_flow_mod()
+                msg.match = of.ofp_match(in_port = src_port,
+                                         dl_src = src, dl_dst = dst)
+                msg.idle_timeout = 10
+                msg.hard_timeout = 30
+                msg.actions.append(of.ofp_action_output(port = dst_port))
+                self.connection.send(msg)
+                n_flows += 1
+
+        barrier = of.ofp_barrier_request()
+        self.restore_barrier_xid = barrier.xid
+        self.connection.send(barrier)
+        log.debug("Restoring %d flows on %s" % (n_flows, self.name))
+
+    def _handle_BarrierIn(self, event):
+        if event.xid != self.restore_barrier_xid:
+            return
+        self.restore_barrier_xid = None
+        log.info("Restored flows installed on %s" % (self.name,))
 
     def _flood(self, event):
         msg = of.ofp_packet_out()
@@ -193,6 +255,45 @@ class PSIKMainServerSwitch(PSIKARPVisibleSwitch):
         connection.send(msg)
         super(PSIKMainServerSwitch, self).set_connection(connection)
 
+    def get_state(self):
+        state = super(PSIKMainServerSwitch, self).get_state()
+        state["dcs_active_load"] = self.dcs_active_load
+        state["srv_active_loads"] = self.srv_active_loads
+        state["srv_wip_loads"] = self.srv_wip_loads
+        return state
+
+    def restore_state(self, state):
+        # Restore load shares before flows are pushed by parent class
+        dcs_active_load = state.get("dcs_active_load")
+        srv_active_loads = state.get("srv_active_loads")
+        srv_wip_loads = state.get("srv_wip_loads")
+
+        try:
+            # Ignore load info if topology has changed since snapshot
+            if (dcs_active_load is not None and srv_active_loads is not None
+                    and srv_wip_loads is not None
+                    and len(dcs_active_load) == len(self.dcs_active_load)
+                    and [len(dc) for dc in srv_active_loads] ==
+                        [len(dc) for dc in self.srv_active_loads]
+                    and [len(dc) for dc in srv_wip_loads] ==
+                        [len(dc) for dc in self.srv_wip_loads]):
+                dcs_active_load = [float(load) for load in dcs_active_load]
+                srv_active_loads = [[float(load) for load in dc]
+                                    for dc in srv_active_loads]
+                srv_wip_loads = [[(int(srv[0]), int(srv[1])) for srv in dc]
+                                 for dc in srv_wip_loads]
+
+                self.dcs_active_load = dcs_active_load
+                self.srv_active_loads = srv_active_loads
+                self.srv_wip_loads = srv_wip_loads
+                log.info("Restored load: " + str(self.dcs_active_load))
+            else:
+                log.warning("Load snapshot doesn't match topology, ignoring")
+        except (IndexError, KeyError, TypeError, ValueError):
+            log.error("Malformed load snapshot, ignoring")
+
+        super(PSIKMainServerSwitch, self).restore_state(state)
+
     def _choose_server(self):
         def weighted_host_choice(target, current):
             weights=list()
@@ -367,7 +468,8 @@ class PSIKMainServerSwitch(PSIKARPVisibleSwitch):
             super(PSIKMainServerSwitch, self)._handle_PacketIn(event)
 
 class PSIKComponent (object):
-    def __init__(self, mss_dpid, mss_ip, mcs_dpid, dcs_dpids, decision_type, dcs_load):
+    def __init__(self, mss_dpid, mss_ip, mcs_dpid, dcs_dpids, decision_type, dcs_load,
+                 state_file = None, state_interval = 5, state_max_age = 30):
         self.mcs = PSIKLearningSwitch("mcs", mcs_dpid)
         self.dcs_load = [float(load[0]) for load in dcs_load]
         self.srv_loads = [load[1] for load in dcs_load]
@@ -379,8 +481,110 @@ class PSIKComponent (object):
             self.dcs.append(PSIKLearningSwitch("dc" + str(i), dpid))
             i += 1
 
+        self.state_file = state_file
+        self.state_max_age = state_max_age
+        self.saved_state = None
+        self.saved_time = 0
+        self.restored_state = {}
+        self.restored_time = time.time()
+        if self.state_file is not None:
+            self.restored_state = self._load_state()
+            recoco.Timer(state_interval, self._save_state, recurring = True)
+            core.addListenerByName("GoingDownEvent", self._handle_GoingDownEvent)
+
         core.openflow.addListeners(self)
 
+    def _switches(self):
+        return [self.mss, self.mcs] + self.dcs
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except IOError:
+            log.info("No saved state found in %s" % (self.state_file,))
+            return {}
+        except ValueError:
+            log.error("Malformed state file %s, ignoring" % (self.state_file,))
+            return {}
+
+        if (not isinstance(state, dict)
+                or not isinstance(state.get("timestamp"), (int, long, float))
+                or not isinstance(state.get("switches"), dict)):
+            log.error("Malformed state file %s, ignoring" % (self.state_file,))
+            return {}
+
+        age = time.time() - state["timestamp"]
+        if not 0 <= age <= self.state_max_age:
+            log.warning("Saved state in %s is %d seconds old, ignoring"
+                        % (self.state_file, age))
+            return {}
+
+        self.restored_time = state["timestamp"]
+        restored_state = {}
+        for switch in self._switches():
+            switch_state = state["switches"].get(switch.name)
+            if switch_state is None:
+                continue
+            if not isinstance(switch_state, dict):
+                log.error("Malformed state of %s switch, ignoring" % (switch.name,))
+            elif switch_state.get("dpid") != switch.dpid:
+                # Don't restore state of one physical switch onto another
+                log.warning("Saved state of %s switch belongs to different dpid, ignoring"
+                            % (switch.name,))
+            else:
+                restored_state[switch.name] = switch_state
+
+        log.info("Loaded saved state from %s" % (self.state_file,))
+        return restored_state
+
+    def _save_state(self):
+        now = time.time()
+        state = dict((switch.name, switch.get_state())
+                     for switch in self._switches())
+        # Don't keep state of switches which never came back forever
+        if self.restored_state and now - self.restored_time > self.state_max_age:
+            log.info("Dropping saved state of switches that didn't reconnect: %s"
+                     % (", ".join(sorted(self.restored_state)),))
+            self.restored_state = {}
+        # Switches which haven't connected yet keep their state from
+        # previous run so it's not lost if we go down again
+        for switch in self._switches():
+            if switch.connection is None and switch.name in self.restored_state:
+                state[switch.name] = self.restored_state[switch.name]
+
+        data = json.dumps(state, separators=(",", ":"), sort_keys=True)
+        # Refresh unchanged snapshot only when it's about to become too old
+        if data == self.saved_state and now - self.saved_time < self.state_max_age / 2:
+            return
+
+        # Write to temporary file and rename, so that crash during write
+        # doesn't leave us with broken snapshot
+        tmp_file = self.state_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                f.write('{"switches":%s,"timestamp":%r}' % (data, now))
+            os.rename(tmp_file, self.state_file)
+            self.saved_state = data
+            self.saved_time = now
+        except (IOError, OSError) as e:
+            log.error("Unable to save state to %s: %s" % (self.state_file, e))
+
+    def _handle_GoingDownEvent(self, event):
+        self._save_state()
+
+    def _restore_switch_state(self, switch):
+        state = self.restored_state.pop(switch.name, None)
+        if state is None:
+            return
+
+        log.info("Restoring state of %s switch" % (switch.name,))
+        try:
+            switch.restore_state(state)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            log.error("Malformed state of %s switch, ignoring: %s"
+                      % (switch.name, e))
+
     def _handle_ConnectionUp(self, event):
         log.debug("Connection %s" % (event.connection,))
 
@@ -388,9 +592,11 @@ class PSIKComponent (object):
         if dpid == self.mss.dpid:
             log.debug("Main server switch found: %s" % (event.connection,))
             self.mss.set_connection(event.connection)
+            self._restore_switch_state(self.mss)
         elif dpid == self.mcs.dpid:
             log.debug("Main client switch found: %s" % (event.connection,))
             self.mcs.set_connection(event.connection)
+            self._restore_switch_state(self.mcs)
         else:
             found = False
             for switch in self.dcs:
@@ -398,6 +604,7 @@ class PSIKComponent (object):
                     found = True
                     log.debug("%s switch found: %s" % (switch.name, event.connection,))
                     switch.set_connection(event.connection)
+                    self._restore_switch_state(switch)
             if not found:
                 log.error("Unable to identify switch: %s" % (event.connection,))
 
@@ -407,7 +614,8 @@ def launch (mss_dpid = "00-00-00-01-00-00|1", mss_ip = None,
                        "00-00-00-01-03-00|103"],
             dcs_load=[(1.0/3, [1.0/3, 1.0/3, 1.0/3]),
                       (1.0/3, [1.0/3, 1.0/3, 1.0/3]),
-                      (1.0/3, [1.0/3, 1.0/3, 1.0/3])]):
+                      (1.0/3, [1.0/3, 1.0/3, 1.0/3])],
+            state_file = "psik_state.json", state_interval = 5, state_max_age = 30):
 
     if mss_ip is None:
         mss_ip = IPAddr("10.254.254.254")
@@ -417,4 +625,17 @@ def launch (mss_dpid = "00-00-00-01-00-00|1", mss_ip = None,
     for i in range(len(dcs_dpids)):
         dcs_dpids[i] = poxutil.str_to_dpid(dcs_dpids[i])
 
-    core.registerNew(PSIKComponent, mss_dpid, mss_ip, mcs_dpid, dcs_dpids, DecisionType.DEC_STATIC, dcs_load)
+    if state_file is True:
+        raise RuntimeError("--state_file requires a file name "
+                           "(use --state_file= to disable)")
+    if state_file == "":
+        state_file = None
+    state_interval = float(state_interval)
+    if state_interval <= 0:
+        raise RuntimeError("--state_interval must be greater than 0")
+    state_max_age = float(state_max_age)
+    if state_max_age < state_interval:
+        raise RuntimeError("--state_max_age must not be less than --state_interval")
+
+    core.registerNew(PSIKComponent, mss_dpid, mss_ip, mcs_dpid, dcs_dpids, DecisionType.DEC_STATIC, dcs_load,
+                     state_file, state_interval, state_max_age)